@@ -0,0 +1,45 @@
+"""Aggregation module
+"""
+import numpy as np
+
+
+def grouped_mean(segment_codes, x_codes, sums, counts, shape):
+    """Grouped mean on a segment by x-axis grid
+
+    This function averages pre-aggregated sums and counts by segment and x-axis value. The
+    groups are given as integer codes, which are combined into one index into a dense grid of
+    the given shape, so the sums and counts of every group are accumulated in a
+    single pass with ``np.bincount``.
+
+    Parameters
+    ----------
+    segment_codes: np.ndarray
+        Integer codes of the segment values, between 0 and ``n_segments - 1``
+    x_codes: np.ndarray
+        Integer codes of the x-axis values, between 0 and ``n_x - 1``
+    sums: np.ndarray
+        Sums of the metric per row
+    counts: np.ndarray
+        Number of non-missing metric values per row
+    shape: (int, int)
+        Shape ``(n_segments, n_x)`` of the grid, the number of possible segment and x-axis values
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Averages of the metric with the shape of the grid and a boolean array of the same
+        shape that is True for the groups that contain any rows.
+    """
+    n_segments, n_x = shape
+    cells = segment_codes.astype(np.int64) * n_x + x_codes
+    size = n_segments * n_x
+
+    group_sums = np.bincount(cells, weights=sums, minlength=size).reshape(n_segments, n_x)
+    group_counts = np.bincount(cells, weights=counts, minlength=size).reshape(n_segments, n_x)
+    observed = np.bincount(cells, minlength=size).reshape(n_segments, n_x) > 0
+
+    # groups without any non-missing values have a missing average, like in pandas
+    averages = np.full((n_segments, n_x), np.nan)
+    np.divide(group_sums, group_counts, out=averages, where=group_counts > 0)
+
+    return averages, observed
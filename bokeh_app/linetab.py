@@ -1,19 +1,86 @@
 """Line tab module
 """
-import pandas as pd
+from collections import OrderedDict
+
+import numpy as np
+from bokeh.io import curdoc
 from bokeh.plotting import figure
 from bokeh.models import (ColumnDataSource, HoverTool, Panel)
-from bokeh.models.widgets import (CheckboxGroup, Select)
+from bokeh.models.widgets import (CheckboxGroup, Div, Select)
 
 from bokeh.layouts import row, WidgetBox
 from bokeh.palettes import Category20_20 # pylint: disable=E0611
 
+from aggregation import grouped_mean
 from core import InteractiveTab
 
+# number of data sets that are kept in memory per tab
+DATASET_CACHE_SIZE = 32
+# milliseconds to wait after a widget change, so that quick successive changes are applied at once
+UPDATE_DELAY_MS = 120
+
+def summarize(data, x_axis, segments, metrics):
+    """Precompute aggregates
+
+    This function aggregates the data once by all segments and the x-axis. The plotted averages
+    are then recombined from these sums and counts instead of the raw rows. The result does not
+    depend on any widget state, so it can be computed once and shared by the tabs of all sessions.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Pandas dataframe with the input data.
+    x_axis: str
+        Name of the x-axis variable as a string
+    segments: [str]
+        List with the names of the segment variables
+    metrics: [str]
+        List with the names of the metric variables
+
+    Returns
+    -------
+    dict
+        Dictionary with the grouped index codes, levels, sums, counts and segment value masks,
+        the segment value colors and the sorted unique values of every segment.
+    """
+    grouped = data.groupby(segments + [x_axis], observed=True)[metrics]
+    sums = grouped.sum()
+    counts = grouped.count()
+
+    # the aggregates are kept as plain arrays, the grouped index stores every column as integer
+    # codes into its sorted unique values (levels)
+    codes = {name: np.asarray(level_codes)
+             for name, level_codes in zip(sums.index.names, sums.index.codes)}
+    levels = dict(zip(sums.index.names, sums.index.levels))
+
+    # membership of the grouped rows for every segment value, one row of the mask per level
+    masks = {segment: codes[segment] == np.arange(len(levels[segment]))[:, np.newaxis]
+             for segment in segments}
+
+    # color of every segment value, following its position among all values of the segment so
+    # that it stays the same when filtering, the palette is cycled if there are more segment
+    # values than colors
+    palette = np.asarray(Category20_20)
+    colors = {segment: palette[np.arange(len(levels[segment])) % len(palette)]
+              for segment in segments}
+
+    return {
+        "codes": codes,
+        "levels": levels,
+        "sums": {metric: sums[metric].to_numpy(dtype=float) for metric in metrics},
+        "counts": {metric: counts[metric].to_numpy(dtype=float) for metric in metrics},
+        "masks": masks,
+        "colors": colors,
+        # sorted unique values of every segment, used as the filter labels
+        "uniques": {segment: np.sort(data[segment].unique()).astype(object)
+                    for segment in segments},
+    }
+
+
 class LineTab(InteractiveTab): # pylint: disable=R0902
     """Line Tab class
 
-    This is the base class that holds the functions to create, style and update a tab that plots
+    This is the base class that holds the functions to create and update a tab that plots
     a number of metrics, segmented by a number of variables with every possible filter
     automatically generated. It has the following features:
 
@@ -24,10 +91,23 @@ class LineTab(InteractiveTab): # pylint: disable=R0902
       list. A widget will be created in which the segment that is used to split the data can be
       selected.
 
+    Parameters
+    ----------
+    data: pd.DataFrame or None
+        Pandas dataframe with the input data. It is only used to compute the summary and is not
+        kept on the tab, so it can be None if the summary is given.
+    x_axis: str
+        Name of the x-axis variable as a string
+    segments: [str]
+        List with the names of the segment variables
+    metrics: [str]
+        List with the names of the metric variables
+    summary: dict, optional
+        Precomputed aggregates of the data as returned by ``summarize``. If not given, they are
+        computed from the data.
+
     Attributes
     ----------
-    data: pd.DataFrame
-        Pandas dataframe with the input data.
     segments: [str]
         List with the names of the segment variables
     x_axis: str
@@ -35,63 +115,119 @@ class LineTab(InteractiveTab): # pylint: disable=R0902
     metrics: [str]
         List with the names of the metric variables
     """
-    def __init__(self, data, x_axis, segments, metrics):
+    def __init__(self, data, x_axis, segments, metrics, summary=None): # pylint: disable=R0913
         # set inputs
-        self.data = data
         self.segments = segments
         self.x_axis = x_axis
         self.metrics = metrics
 
+        # the precomputed aggregates can be shared between tabs of different sessions
+        if summary is None:
+            if data is None:
+                raise ValueError("Either the data or its summary has to be given.")
+            summary = summarize(data, x_axis, segments, metrics)
+        self._group_codes = summary["codes"]
+        self._group_levels = summary["levels"]
+        self._group_sums = summary["sums"]
+        self._group_counts = summary["counts"]
+        self._group_masks = summary["masks"]
+        self._segment_colors = summary["colors"]
+        self._uniques = summary["uniques"]
+
+        self._dataset_cache = OrderedDict()
+
         # initializes the tab
         self.tab = self._initialize_tab()
 
     def _initialize_tab(self):
         """Create tab structure
 
-        This internal function initializes the dataset, the widgets, the plot and the tab. The
-        widgets for the segment and metric selections are created and initialized. The same is
-        done with the filters and the variables to filter. Then, based on the initial selections,
-        the data source is created and the plot is initialized. Subsequently, the layout is created
-        and the tab is set as self.tab.
+        This internal function initializes the widgets, the layout and the tab. The plot is only
+        a placeholder at first: building the data source and the plot is deferred to the next
+        tick of the document, so the page is sent to the browser without waiting for the
+        aggregation.
+        """
+        self.segment_select, self.metric_select, self.segment_filters = self._build_widgets()
+
+        # placeholder until the plot is built
+        self.source = None
+        self._last_selection = None
+        self._update_pending = False
+        self.bokeh_plot = Div(text="Loading...")
+
+        self.controls = WidgetBox(self.segment_select, self.metric_select)
+        self.filters = WidgetBox(
+            *list(self.segment_filters[segment] for segment in self.segment_filters))
+        self.layout = row(self.controls, self.bokeh_plot, self.filters)
+
+        self._document = curdoc()
+        self._document.add_next_tick_callback(self._build_plot)
+
+        return Panel(child=self.layout, title="Segment metrics")
+
+    def _build_widgets(self):
+        """Create widgets
+
+        This internal function creates the widgets for the segment and metric selections as well
+        as the filters for every segment, with all segment values selected.
+
+        Returns
+        -------
+        (bokeh.models.widgets.Select, bokeh.models.widgets.Select, dict)
+            Segment select, metric select and dictionary with the segment names as keys and the
+            filter checkbox groups as values.
         """
         # set widgets
-        self.segment_select = Select(title="Segments", value=self.segments[0],
-                                     options=self.segments)
-        self.segment_select.on_change("value", self.update)
+        segment_select = Select(title="Segments", value=self.segments[0], options=self.segments)
+        segment_select.on_change("value", self.update)
 
-        self.metric_select = Select(title="Metrics", value=self.metrics[0],
-                                    options=self.metrics)
-        self.metric_select.on_change("value", self.update)
+        metric_select = Select(title="Metrics", value=self.metrics[0], options=self.metrics)
+        metric_select.on_change("value", self.update)
 
         # set filters
-        self.segment_filters = {}
+        segment_filters = {}
         for segment in self.segments:
-            available_segments = list(set(self.data[segment]))
-            self.segment_filters[segment] = CheckboxGroup(labels=available_segments,
-                                                          active=list(
-                                                              range(len(available_segments))))
-            self.segment_filters[segment].on_change("active", self.update)
-
-        # initialize filters
-        initial_segment = self.segment_select.value
-        initial_metric = self.metric_select.value
-        initial_filters = {}
-        for segment in self.segments:
-            initial_filters[segment] = [
-                self.segment_filters[segment].labels[i]
-                for i in self.segment_filters[segment].active
-            ]
+            available_segments = self._uniques[segment].tolist()
+            segment_filters[segment] = CheckboxGroup(labels=available_segments,
+                                                     active=list(range(len(available_segments))))
+            segment_filters[segment].on_change("active", self.update)
+
+        return segment_select, metric_select, segment_filters
 
-        self.source = self.make_dataset(initial_segment, initial_metric, initial_filters)
+    def _build_plot(self):
+        """Create plot
+
+        This internal function creates the data source based on the current selections, creates
+        the plot and swaps it into the layout in place of the placeholder.
+        """
+        segment, metric, segments_to_filter = self._get_selection()
+
+        self.source = self.make_dataset(segment, metric, segments_to_filter)
+        self._last_selection = (segment, metric, segments_to_filter)
         self.bokeh_plot = self.make_plot(self.source)
-        self.bokeh_plot = self.style(self.bokeh_plot)
 
-        self.controls = WidgetBox(self.segment_select, self.metric_select)
-        self.filters = WidgetBox(
-            *list(self.segment_filters[segment] for segment in self.segment_filters))
-        self.layout = row(self.controls, self.bokeh_plot, self.filters)
+        self.layout.children[1] = self.bokeh_plot
 
-        return Panel(child=self.layout, title="Segment metrics")
+    def _get_selection(self):
+        """Get current selection
+
+        This internal function reads the selected segment and metric and the selected values of
+        every segment filter from the widgets.
+
+        Returns
+        -------
+        (str, str, dict)
+            Selected segment, selected metric and dictionary with the column names for the
+            segments as keys and the selected values for each segment variable as values.
+        """
+        segment = self.segment_select.value
+        metric = self.metric_select.value
+        segments_to_filter = {}
+        for segment_to_filter in self.segments:
+            segments_to_filter[segment_to_filter] = self._uniques[segment_to_filter][
+                self.segment_filters[segment_to_filter].active].tolist()
+
+        return segment, metric, segments_to_filter
 
     def make_dataset(self, segment, metric, segments_to_filter):
         """Make Bokeh dataset
@@ -113,31 +249,91 @@ class LineTab(InteractiveTab): # pylint: disable=R0902
         bokeh.ColumnDataSource
             Data source that underlies the bokeh plot
         """
-        data_filtered = self.data.copy()
-        for segment_to_filter in segments_to_filter:
-            data_filtered = data_filtered.loc[data_filtered[segment_to_filter].isin(
-                segments_to_filter[segment_to_filter])]
-
-        segment_values = list(set(data_filtered[segment]))
-
-        dataframes = []
-        # iterate through segment values
-        for i, segment_value in enumerate(segment_values):
-            # subset to the segment value and average by x_axis values
-            segment_data = data_filtered[data_filtered[segment] == segment_value]
-            segment_average = segment_data[
-                [metric, self.x_axis]].groupby(self.x_axis).mean().reset_index()
-            segment_average = segment_average.rename(columns={metric: "metric"})
-            segment_average["name"] = segment_value
-            segment_average["color"] = Category20_20[i]
-            dataframes.append(segment_average)
-
-        datasource = pd.concat(dataframes)
-        datasource = datasource.sort_values(["name", self.x_axis])
-        source = ColumnDataSource(datasource)
+        # previously seen selections are served from the cache, e.g. when toggling back and forth
+        key = (segment, metric,
+               tuple((segment_to_filter, frozenset(values))
+                     for segment_to_filter, values in segments_to_filter.items()))
+        if key not in self._dataset_cache:
+            self._dataset_cache[key] = self._aggregate(segment, metric, segments_to_filter)
+            if len(self._dataset_cache) > DATASET_CACHE_SIZE:
+                self._dataset_cache.popitem(last=False)
+
+        # the cached arrays are copied so that changes to the data source do not alter the cache
+        source = ColumnDataSource(data={column: values.copy()
+                                        for column, values in self._dataset_cache[key].items()})
 
         return source
 
+    def _aggregate(self, segment, metric, segments_to_filter):
+        """Aggregate the plotted data
+
+        This internal method averages the metric by segment and x-axis values from the grouped
+        sums and counts, after applying the filters.
+
+        Parameters
+        ----------
+        segment: str
+            Column name for the segment variable that is used to segment the data
+        metric: str
+            Column name for the metric that is plotted
+        segments_to_filter: dict
+            Dictionary with the column names for the segments as keys and the value for each
+            segment variable that are supposed to the plotted as values.
+
+        Returns
+        -------
+        dict
+            Dictionary with the column names as keys and numpy arrays as values
+        """
+        averages, observed = self._average(segment, metric, segments_to_filter)
+
+        # the observed groups of the grid, which are already ordered by segment and x_axis values
+        # because the levels of the grouped index are sorted
+        segment_positions, x_positions = np.nonzero(observed)
+
+        return {
+            "name": self._group_levels[segment][segment_positions].to_numpy(),
+            self.x_axis: self._group_levels[self.x_axis][x_positions].to_numpy(),
+            "metric": averages[observed],
+            "color": self._segment_colors[segment][segment_positions],
+        }
+
+    def _average(self, segment, metric, segments_to_filter):
+        """Average on the segment by x-axis grid
+
+        This internal method applies the filters to the grouped sums and counts and averages the
+        metric on a grid of all segment and x-axis values.
+
+        Parameters
+        ----------
+        segment: str
+            Column name for the segment variable that is used to segment the data
+        metric: str
+            Column name for the metric that is plotted
+        segments_to_filter: dict
+            Dictionary with the column names for the segments as keys and the value for each
+            segment variable that are supposed to the plotted as values.
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            Averages of the metric on the grid and a boolean array that is True for the groups
+            that contain any rows.
+        """
+        # the masks of the selected values are combined with OR within a segment and with AND
+        # across the segments
+        keep = np.ones(len(self._group_codes[self.x_axis]), dtype=bool)
+        for segment_to_filter, values in segments_to_filter.items():
+            positions = self._group_levels[segment_to_filter].get_indexer(values)
+            keep &= self._group_masks[segment_to_filter][positions[positions >= 0]].any(axis=0)
+
+        return grouped_mean(self._group_codes[segment][keep],
+                            self._group_codes[self.x_axis][keep],
+                            self._group_sums[metric][keep],
+                            self._group_counts[metric][keep],
+                            (len(self._group_levels[segment]),
+                             len(self._group_levels[self.x_axis])))
+
     def make_plot(self, source):
         """Create bokeh plot
 
@@ -168,54 +364,102 @@ class LineTab(InteractiveTab): # pylint: disable=R0902
 
         return bokeh_plot
 
-    def style(self, bokeh_plot):
-        """Style method
+    def update(self, attr, old, new): # pylint: disable=W0613
+        """Update datasource
 
-        This method applies the stile we want to the bokeh plot.
+        This method updates the datasource underlying the plot. Its form is governed by
+        bokeh and the old dataset can be accessed via ``old`` and the new one via ``new``.
 
-        Parameters
-        ----------
-        bokeh_plot: bokeh.plotting.figure
-            Bokeh figure to which the styling will be applied.
+        The update itself is delayed by ``UPDATE_DELAY_MS``, so a burst of widget changes results
+        in a single update with the selection at that point.
+        """
+        # the plot picks up the current selection once it is built
+        if self.source is None or self._update_pending:
+            return
 
-        Returns
-        -------
-        bokeh.plotting.figure
-            The figure object to which the styling has been applied.
+        self._update_pending = True
+        self._document.add_timeout_callback(self._apply_update, UPDATE_DELAY_MS)
+
+    def _apply_update(self):
+        """Apply pending update
+
+        This internal method updates the datasource based on the current selection. If only the
+        filter of the plotted segment changed, the rows of the removed segment values are dropped
+        and the rows of the added ones are streamed to the data source. If only the metric changed,
+        the plotted groups stay the same and only the metric column is replaced. Otherwise the
+        whole data source is replaced.
         """
-        # title
-        bokeh_plot.title.align = "center"
-        bokeh_plot.title.text_font_size = "20pt"
-        bokeh_plot.title.text_font = "serif"
+        self._update_pending = False
 
-        # axis labels
-        bokeh_plot.xaxis.axis_label_text_font_size = "14pt"
-        bokeh_plot.xaxis.axis_label_text_font_style = "bold"
-        bokeh_plot.yaxis.axis_label_text_font_size = "14pt"
-        bokeh_plot.yaxis.axis_label_text_font_style = "bold"
+        segment, metric, segments_to_filter = self._get_selection()
 
-        # tick labels
-        bokeh_plot.xaxis.major_label_text_font_size = "12pt"
-        bokeh_plot.yaxis.major_label_text_font_size = "12pt"
+        last_segment, last_metric, last_filters = self._last_selection
+        changed_filters = [segment_to_filter for segment_to_filter in self.segments
+                           if set(segments_to_filter[segment_to_filter])
+                           != set(last_filters[segment_to_filter])]
 
-        return bokeh_plot
+        if segment == last_segment and metric != last_metric and not changed_filters:
+            self._replace_metric(segment, metric, segments_to_filter)
+        elif segment == last_segment and metric == last_metric and changed_filters == [segment]:
+            self._stream_filter_change(segment, metric, segments_to_filter, last_filters[segment])
+        else:
+            # get the new dataset
+            new_source = self.make_dataset(segment, metric, segments_to_filter)
 
-    def update(self, attr, old, new): # pylint: disable=W0613
-        """Update datasource
+            self.source.data.update(new_source.data) # pylint: disable=E1101
 
-        This method updates the datasource underlying the plot. Its form is governed by
-        bokeh and the old dataset can be accessed via ``old`` and the new one via ``new``.
+        self._last_selection = (segment, metric, segments_to_filter)
+
+    def _replace_metric(self, segment, metric, segments_to_filter):
+        """Replace plotted metric
+
+        This internal method replaces the metric column of the data source when only the metric
+        changed, since the plotted groups stay the same.
+
+        Parameters
+        ----------
+        segment: str
+            Column name for the segment variable that is used to segment the data
+        metric: str
+            Column name for the metric that is plotted
+        segments_to_filter: dict
+            Dictionary with the column names for the segments as keys and the value for each
+            segment variable that are supposed to the plotted as values.
         """
-        segment = self.segment_select.value
-        metric = self.metric_select.value
-        segments_to_filter = {}
-        for segment_to_filter in self.segments:
-            segments_to_filter[segment_to_filter] = [
-                self.segment_filters[segment_to_filter].labels[i]
-                for i in self.segment_filters[segment_to_filter].active
-            ]
+        # look up the averages of the plotted rows, which may not be in grid order after streaming
+        averages, _ = self._average(segment, metric, segments_to_filter)
+        segment_positions = self._group_levels[segment].get_indexer(
+            np.asarray(self.source.data["name"]))
+        x_positions = self._group_levels[self.x_axis].get_indexer(
+            np.asarray(self.source.data[self.x_axis]))
+        self.source.data["metric"] = averages[segment_positions, x_positions]
+
+    def _stream_filter_change(self, segment, metric, segments_to_filter, last_values):
+        """Apply change of the plotted segment's filter
 
-        # get the new dataset
-        new_source = self.make_dataset(segment, metric, segments_to_filter)
+        This internal method drops the rows of the segment values that were deselected from the
+        data source and streams the rows of the newly selected ones to it.
 
-        self.source.data.update(new_source.data) # pylint: disable=E1101
+        Parameters
+        ----------
+        segment: str
+            Column name for the segment variable that is used to segment the data
+        metric: str
+            Column name for the metric that is plotted
+        segments_to_filter: dict
+            Dictionary with the column names for the segments as keys and the value for each
+            segment variable that are supposed to the plotted as values.
+        last_values: list
+            Values of the plotted segment that were selected before the change
+        """
+        added = [value for value in segments_to_filter[segment] if value not in last_values]
+        removed = [value for value in last_values if value not in segments_to_filter[segment]]
+
+        if removed:
+            keep = ~np.isin(np.asarray(self.source.data["name"]), removed)
+            self.source.data = {column: np.asarray(values)[keep]
+                                for column, values in self.source.data.items()}
+        if added:
+            # aggregated directly, so the cache only holds complete selections
+            added_filters = dict(segments_to_filter, **{segment: added})
+            self.source.stream(self._aggregate(segment, metric, added_filters))
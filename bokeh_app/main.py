@@ -1,29 +1,24 @@
 """Main module that creates the bokeh server app
 """
-from os.path import dirname, join
-
-import pandas as pd
 from bokeh.io import curdoc
 from bokeh.models.widgets import Tabs
 
 from linetab import LineTab
+from superstore import METRICS, SEGMENTS, X_AXIS, load_shared_state
+from theme import theme
 
 
-data = pd.read_excel(join(dirname(__file__), "superstore.xls"))
-data = data.fillna("NULL")
-data['year'] = data['Order Date'].dt.year.astype(str)
-data['month'] = pd.DatetimeIndex(data['Order Date']).month
-
-x_axis = 'month'
-segments = ["year", "Category", "Sub-Category", "Region"]
-metrics = ["Sales", "Quantity", "Profit"]
+# the aggregates of the data are computed once and shared between sessions, only the bokeh models
+# belong to a session
+summary = load_shared_state()
 
 # create tab
 # here, intialize all tabs of the app
-line_tab = LineTab(data, x_axis, segments, metrics).tab
+line_tab = LineTab(None, X_AXIS, SEGMENTS, METRICS, summary=summary).tab
 
 # put all tabs into Tabs
 tabs = Tabs(tabs=[line_tab])
 
-# put tabs in the current document
+# put tabs in the current document, the theme styles all plots
+curdoc().theme = theme
 curdoc().add_root(tabs)
@@ -0,0 +1,87 @@
+"""Superstore data module
+"""
+from functools import lru_cache
+from os import getpid, remove, replace
+from os.path import dirname, exists, getmtime, join
+
+import pandas as pd
+
+from linetab import summarize
+
+
+X_AXIS = 'month'
+SEGMENTS = ["year", "Category", "Sub-Category", "Region"]
+METRICS = ["Sales", "Quantity", "Profit"]
+
+
+def load_data():
+    """Load superstore data
+
+    This function loads the superstore sample, derives the year and month from the order date
+    and converts the columns to compact types.
+
+    Returns
+    -------
+    pd.DataFrame
+        Pandas dataframe with the superstore data
+    """
+    # only load the columns that are needed, year and month are derived from the order date
+    columns = ["Order Date", "Category", "Sub-Category", "Region"] + METRICS
+    excel_path = join(dirname(__file__), "superstore.xls")
+    parquet_path = join(dirname(__file__), "superstore.parquet")
+
+    # parsing the excel file is slow, so the loaded columns are stored as parquet on the first start
+    data = None
+    if exists(parquet_path) and (not exists(excel_path)
+                                 or getmtime(parquet_path) >= getmtime(excel_path)):
+        try:
+            data = pd.read_parquet(parquet_path, columns=columns)
+        except (ImportError, KeyError, ValueError, OSError):
+            # no parquet engine is installed, or the file is unreadable or misses columns that
+            # were added to the lists above, so it is rebuilt from the excel file
+            pass
+
+    if data is None:
+        data = pd.read_excel(excel_path, usecols=columns)
+
+        # the cache is optional, so failing to write it must not stop the app, and the file is
+        # written to a temporary path first so an interrupted write never leaves a corrupt cache
+        temporary_path = "{}.{}.tmp".format(parquet_path, getpid())
+        try:
+            data.to_parquet(temporary_path)
+            replace(temporary_path, parquet_path)
+        except (ImportError, OSError):
+            if exists(temporary_path):
+                remove(temporary_path)
+
+    data = data.fillna("NULL")
+    data['year'] = data['Order Date'].dt.year.astype(str)
+    data['month'] = pd.DatetimeIndex(data['Order Date']).month
+
+    # single precision is enough for plotting the metrics and halves the memory that is aggregated
+    for metric in METRICS:
+        data[metric] = pd.to_numeric(data[metric], downcast="float")
+    data[X_AXIS] = pd.to_numeric(data[X_AXIS], downcast="unsigned")
+
+    # segment columns are categorical so that grouping and filtering work on integer codes
+    for segment in SEGMENTS:
+        data[segment] = data[segment].astype("category")
+
+    return data
+
+
+@lru_cache(maxsize=1)
+def load_shared_state():
+    """Load shared state
+
+    The bokeh server runs ``main.py`` for every session, while this module is only imported once.
+    Caching the aggregates here means they are only computed for the first session and shared by
+    all later ones. Only the aggregates are returned, so the raw data is not kept alive by the
+    cache.
+
+    Returns
+    -------
+    dict
+        Aggregates of the superstore data as returned by ``linetab.summarize``
+    """
+    return summarize(load_data(), X_AXIS, SEGMENTS, METRICS)
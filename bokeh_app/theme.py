@@ -0,0 +1,20 @@
+"""Theme module
+"""
+from bokeh.themes import Theme
+
+
+# styling of all plots in the app, set as the theme of the document in main.py
+theme = Theme(json={
+    "attrs": {
+        "Title": {
+            "align": "center",
+            "text_font_size": "20pt",
+            "text_font": "serif",
+        },
+        "Axis": {
+            "axis_label_text_font_size": "14pt",
+            "axis_label_text_font_style": "bold",
+            "major_label_text_font_size": "12pt",
+        },
+    }
+})